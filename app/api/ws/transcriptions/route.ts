@@ -1,12 +1,25 @@
 import { WebSocketServer, WebSocket } from "ws";
 import { NextRequest } from "next/server";
-import { mintEphemeralToken, openOpenAIRealtime } from "@/lib/openai";
+import {
+  mintEphemeralToken,
+  openOpenAIRealtime,
+  createAudioBatcher,
+  normalizeLanguage,
+  relayOpenAIMessage,
+  sendToClient,
+  CONNECTED_MESSAGE,
+  READY_MESSAGE,
+  UPSTREAM_ALREADY_STARTED_MESSAGE,
+} from "@/lib/openai";
 
 export const runtime = "nodejs";
 export const dynamic = "force-dynamic";
 
+const DEFAULT_MODEL = process.env.MODEL_NAME || 'gpt-4o-transcribe';
+
 interface CustomWebSocket extends WebSocket {
   upstream?: WebSocket;
+  sendAudio?: (chunk: Buffer) => void;
   isAlive?: boolean;
 }
 
@@ -26,123 +39,102 @@ if (!wss) {
     perMessageDeflate: false
   });
 
-  wss.on('connection', async (client: CustomWebSocket, req: any) => {
+  wss.on('connection', (client: CustomWebSocket, req: any) => {
     const clientIp = req.headers['x-forwarded-for'] || req.socket?.remoteAddress || 'unknown';
     console.log(`[WebSocket] Client connected: ${clientIp}`);
     client.isAlive = true;
 
     // Send initial connection acknowledgment
-    client.send(JSON.stringify({ type: 'connected', message: 'WebSocket connection established' }));
+    sendToClient(client, CONNECTED_MESSAGE);
 
     client.on('pong', () => {
       client.isAlive = true;
     });
 
-    client.on('message', async (message: Buffer | string) => {
-      if (typeof message === 'string') {
+    // Session setup is the only part that awaits. Keeping it out of the message
+    // handler means audio frames are handled without allocating a promise each.
+    const startTranscription = async (msg: any) => {
+      if (client.upstream && client.upstream.readyState === WebSocket.OPEN) {
+        console.warn(`[WebSocket] Client ${clientIp} tried to start existing upstream connection.`);
+        sendToClient(client, UPSTREAM_ALREADY_STARTED_MESSAGE);
+        return;
+      }
+
+      // Only the primary subtag is used (pt-BR becomes pt); anything else is rejected
+      const lang = normalizeLanguage(msg.lang || 'en');
+      if (lang === undefined) {
+        console.warn(`[WebSocket] Client ${clientIp} requested unsupported language:`, msg.lang);
+        sendToClient(client, JSON.stringify({ error: "unsupported_language", detail: `Unsupported language: ${msg.lang}` }));
+        return;
+      }
+      const model = msg.model || DEFAULT_MODEL;
+      console.log(`[WebSocket] Starting transcription for ${clientIp}. Lang: ${lang}, Model: ${model}`);
+
+      try {
+        // Get ephemeral token from OpenAI
+        console.log(`[WebSocket] Minting ephemeral token for ${clientIp}...`);
+        const token = await mintEphemeralToken(model);
+        console.log(`[WebSocket] Token minted successfully for ${clientIp}`);
+        
+        // Open connection to OpenAI
+        console.log(`[WebSocket] Opening upstream connection for ${clientIp}...`);
+        const upstream = await openOpenAIRealtime(token, lang);
+        if (client.readyState !== WebSocket.OPEN) {
+          // Client left while the upstream was connecting; close it instead of leaking it
+          console.log(`[WebSocket] Client ${clientIp} disconnected during setup, closing upstream`);
+          upstream.close();
+          return;
+        }
+        client.upstream = upstream;
+        client.sendAudio = createAudioBatcher(upstream);
+        console.log(`[WebSocket] Upstream connection established for ${clientIp}`);
+
+        // openOpenAIRealtime resolves once the socket is open, so 'open' has already fired
+        sendToClient(client, READY_MESSAGE);
+
+        upstream.on('message', (data: Buffer) => relayOpenAIMessage(client, clientIp, data));
+
+        upstream.on('close', (code, reason) => {
+          console.log(`[WebSocket] Upstream closed for ${clientIp}. Code: ${code}`);
+          if (client.readyState === WebSocket.OPEN) {
+            client.close();
+          }
+          client.upstream = undefined;
+          client.sendAudio = undefined;
+        });
+
+        upstream.on('error', (err: Error) => {
+          console.error(`[WebSocket] Upstream error for ${clientIp}:`, err);
+          if (client.readyState === WebSocket.OPEN) {
+            sendToClient(client, JSON.stringify({ error: "openai_connection_failed", detail: err.message }));
+            client.close();
+          }
+          client.upstream = undefined;
+          client.sendAudio = undefined;
+        });
+
+      } catch (err: any) {
+        console.error(`[WebSocket] Setup error for ${clientIp}:`, err);
+        sendToClient(client, JSON.stringify({ error: "upstream_setup_failed", detail: err.message }));
+      }
+    };
+
+    client.on('message', (message: Buffer, isBinary: boolean) => {
+      if (!isBinary) {
         try {
-          const msg = JSON.parse(message);
+          const msg = JSON.parse(message.toString());
           console.log(`[WebSocket] Received JSON from ${clientIp}:`, msg);
 
           if (msg.action === 'start') {
-            if (client.upstream && client.upstream.readyState === WebSocket.OPEN) {
-              console.warn(`[WebSocket] Client ${clientIp} tried to start existing upstream connection.`);
-              client.send(JSON.stringify({ error: "upstream_already_started" }));
-              return;
-            }
-
-            const lang = msg.lang || 'en';
-            const model = msg.model || process.env.MODEL_NAME || 'gpt-4o-transcribe';
-            console.log(`[WebSocket] Starting transcription for ${clientIp}. Lang: ${lang}, Model: ${model}`);
-
-            try {
-              // Get ephemeral token from OpenAI
-              console.log(`[WebSocket] Minting ephemeral token for ${clientIp}...`);
-              const token = await mintEphemeralToken(model);
-              console.log(`[WebSocket] Token minted successfully for ${clientIp}`);
-              
-              // Open connection to OpenAI
-              console.log(`[WebSocket] Opening upstream connection for ${clientIp}...`);
-              const upstream = await openOpenAIRealtime(token);
-              client.upstream = upstream;
-              console.log(`[WebSocket] Upstream connection established for ${clientIp}`);
-
-              upstream.on('open', () => {
-                console.log(`[WebSocket] Upstream opened for ${clientIp}`);
-                client.send(JSON.stringify({ ready: true }));
-              });
-
-              upstream.on('message', (data: Buffer | string) => {
-                try {
-                  const openaiMessage = JSON.parse(data.toString());
-                  console.log(`[WebSocket] OpenAI message for ${clientIp}:`, openaiMessage.type);
-                  
-                  // Transform OpenAI events to our format
-                  if (openaiMessage.type === 'conversation.item.input_audio_transcription.delta') {
-                    client.send(JSON.stringify({ 
-                      type: 'partial', 
-                      text: openaiMessage.delta,
-                      item_id: openaiMessage.item_id 
-                    }));
-                  } else if (openaiMessage.type === 'conversation.item.input_audio_transcription.completed') {
-                    client.send(JSON.stringify({ 
-                      type: 'final', 
-                      text: openaiMessage.transcript,
-                      item_id: openaiMessage.item_id 
-                    }));
-                  } else if (openaiMessage.type === 'input_audio_buffer.committed') {
-                    console.log(`[WebSocket] Audio committed for ${clientIp}, item: ${openaiMessage.item_id}`);
-                  } else if (openaiMessage.type === 'error') {
-                    console.error(`[WebSocket] OpenAI error for ${clientIp}:`, openaiMessage);
-                    client.send(JSON.stringify({ 
-                      error: 'openai_error', 
-                      detail: openaiMessage.error?.message || 'Unknown error' 
-                    }));
-                  } else {
-                    // Forward other events
-                    client.send(data.toString());
-                  }
-                } catch (err) {
-                  console.warn(`[WebSocket] Non-JSON from OpenAI for ${clientIp}:`, data.toString().substring(0, 100));
-                  client.send(data.toString());
-                }
-              });
-
-              upstream.on('close', (code, reason) => {
-                console.log(`[WebSocket] Upstream closed for ${clientIp}. Code: ${code}`);
-                if (client.readyState === WebSocket.OPEN) {
-                  client.close();
-                }
-                client.upstream = undefined;
-              });
-
-              upstream.on('error', (err: Error) => {
-                console.error(`[WebSocket] Upstream error for ${clientIp}:`, err);
-                if (client.readyState === WebSocket.OPEN) {
-                  client.send(JSON.stringify({ error: "openai_connection_failed", detail: err.message }));
-                  client.close();
-                }
-                client.upstream = undefined;
-              });
-
-            } catch (err: any) {
-              console.error(`[WebSocket] Setup error for ${clientIp}:`, err);
-              client.send(JSON.stringify({ error: "upstream_setup_failed", detail: err.message }));
-            }
+            startTranscription(msg);
           }
         } catch (e) {
           console.warn(`[WebSocket] Invalid JSON from ${clientIp}:`, message.toString().substring(0, 100));
         }
-      } else if (message instanceof Buffer) {
-        // Forward binary audio data to OpenAI
-        if (client.upstream && client.upstream.readyState === WebSocket.OPEN) {
-          const base64Audio = message.toString('base64');
-          const audioEvent = {
-            type: "input_audio_buffer.append",
-            audio: base64Audio
-          };
-          client.upstream.send(JSON.stringify(audioEvent));
-        }
+      } else {
+        // Forward binary audio data to OpenAI without decoding it to a string first
+        // sendAudio is only set while an upstream session is attached
+        client.sendAudio?.(message);
       }
     });
 
@@ -2,6 +2,9 @@
 
 import React, { useState, useEffect, useRef } from 'react';
 
+// The server sends UTF-8 JSON in binary frames
+const textDecoder = new TextDecoder();
+
 const TestPage: React.FC = () => {
   const [ws, setWs] = useState<WebSocket | null>(null);
   const [wsReady, setWsReady] = useState(false);
@@ -23,6 +26,7 @@ const TestPage: React.FC = () => {
     const wsUrl = `${protocol}//${window.location.host}/api/ws/transcriptions`;
     appendLog(`Attempting to connect to WebSocket: ${wsUrl}`);
     const newWs = new WebSocket(wsUrl);
+    newWs.binaryType = 'arraybuffer';
 
     newWs.onopen = () => {
       appendLog('WebSocket connection established.');
@@ -31,9 +35,10 @@ const TestPage: React.FC = () => {
     };
 
     newWs.onmessage = (event) => {
-      appendLog(`Received message: ${event.data}`);
+      const data = typeof event.data === 'string' ? event.data : textDecoder.decode(event.data as ArrayBuffer);
+      appendLog(`Received message: ${data}`);
       try {
-        const parsedData = JSON.parse(event.data as string);
+        const parsedData = JSON.parse(data);
         if (parsedData.ready) {
           appendLog('Server upstream connection is ready.');
         } else if (parsedData.error) {
@@ -45,7 +50,7 @@ const TestPage: React.FC = () => {
         }
       } catch (error) {
         // Not a JSON message, log raw
-        appendLog(`Received raw data: ${event.data}`);
+        appendLog(`Received raw data: ${data}`);
       }
     };
 
@@ -0,0 +1,6 @@
+import nextEnv from '@next/env';
+
+// Next only loads .env* files inside app.prepare(), but server.js and
+// lib/openai.js read their settings when they are first imported. Importing
+// this module first loads the same files before any of those reads happen.
+nextEnv.loadEnvConfig(process.cwd(), process.env.NODE_ENV !== 'production');
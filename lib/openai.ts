@@ -1,5 +1,30 @@
+import https from 'https';
 import WebSocket from 'ws';
 
+// Shared across sessions so each new Realtime connection can resume a cached
+// TLS session with api.openai.com instead of doing a full handshake.
+// fetch() already pools its connections through the global undici agent.
+const openaiAgent = new https.Agent({ maxCachedSessions: 256 });
+
+// process.env lookups go through a native getter; read settings once at load.
+const OPENAI_API_KEY = process.env.OPENAI_API_KEY;
+
+// Send raw PCM16 as binary frames instead of base64-encoded JSON events.
+// Only enable this against an endpoint that accepts binary audio frames.
+const BINARY_FRAMES = process.env.OPENAI_BINARY_FRAMES === 'true';
+
+// Per-message logging runs on every upstream event, so it is opt-in
+const DEBUG = process.env.LOG_LEVEL === 'debug';
+
+// Only the base64 payload of an append event varies, and base64 never needs
+// JSON escaping, so the envelope is assembled from pre-encoded bytes.
+const AUDIO_APPEND_PREFIX = Buffer.from('{"type":"input_audio_buffer.append","audio":"');
+const AUDIO_APPEND_SUFFIX = Buffer.from('"}');
+
+// Upper bound for a single batched append so we stay well under the
+// per-message size limit of the Realtime API.
+const MAX_AUDIO_BATCH_BYTES = 64 * 1024;
+
 /**
  * Mints an ephemeral token for OpenAI's real-time transcription service.
  */
@@ -11,7 +36,7 @@ export async function mintEphemeralToken(model: string): Promise<string> {
     const response = await fetch("https://api.openai.com/v1/realtime/sessions", {
       method: "POST",
       headers: {
-        "Authorization": `Bearer ${process.env.OPENAI_API_KEY}`,
+        "Authorization": `Bearer ${OPENAI_API_KEY}`,
         "Content-Type": "application/json",
       },
       body: JSON.stringify({
@@ -34,16 +59,70 @@ export async function mintEphemeralToken(model: string): Promise<string> {
   }
 }
 
+// Serialized transcription_session.update payloads keyed by language. The
+// language comes from the client, so it must look like an ISO-639 code
+// before it is sent upstream or cached. That bounds the keys to short
+// lowercase codes, so the cache needs no cap.
+const LANGUAGE_CODE = /^[a-z]{2,3}$/;
+const sessionConfigCache = new Map<string, string>();
+
+/**
+ * Reduces a client-supplied language tag to its lowercase primary subtag
+ * (pt-BR becomes pt). Returns undefined when that is not an ISO-639 code.
+ */
+export function normalizeLanguage(lang: unknown): string | undefined {
+  if (typeof lang !== 'string') return undefined;
+  const primary = lang.split('-', 1)[0].toLowerCase();
+  return LANGUAGE_CODE.test(primary) ? primary : undefined;
+}
+
+/**
+ * Returns the serialized transcription_session.update event for a language
+ * code already checked by normalizeLanguage.
+ */
+function sessionConfigFor(lang: string): string {
+  let payload = sessionConfigCache.get(lang);
+  if (payload === undefined) {
+    payload = JSON.stringify({
+      type: "transcription_session.update",
+      input_audio_format: "pcm16",
+      input_audio_transcription: {
+        model: "gpt-4o-transcribe",
+        language: lang
+      },
+      turn_detection: {
+        type: "server_vad",
+        threshold: 0.5,
+        prefix_padding_ms: 300,
+        silence_duration_ms: 500,
+      },
+      input_audio_noise_reduction: {
+        type: "near_field"
+      }
+    });
+    sessionConfigCache.set(lang, payload);
+  }
+  return payload;
+}
+
 /**
  * Opens a WebSocket connection to OpenAI's real-time transcription endpoint.
  */
-export async function openOpenAIRealtime(token: string): Promise<WebSocket> {
+export async function openOpenAIRealtime(token: string, lang = 'en'): Promise<WebSocket> {
+  const language = normalizeLanguage(lang);
+  if (language === undefined) {
+    throw new Error(`Unsupported language: ${lang}`);
+  }
+
   console.log(`[OpenAI Lib] Opening real-time WebSocket connection to OpenAI`);
   
   const serviceUrl = 'wss://api.openai.com/v1/realtime?intent=transcription';
 
   return new Promise((resolve, reject) => {
     const ws = new WebSocket(serviceUrl, {
+      agent: openaiAgent,
+      // Base64 audio is high-entropy, so permessage-deflate would burn CPU for little gain
+      perMessageDeflate: false,
       headers: { 
         'Authorization': `Bearer ${token}`,
         'OpenAI-Beta': 'realtime=v1'
@@ -54,25 +133,7 @@ export async function openOpenAIRealtime(token: string): Promise<WebSocket> {
       console.log(`[OpenAI Lib] WebSocket connection opened to OpenAI Realtime API`);
       
       // Send initial transcription session configuration
-      const config = {
-        type: "transcription_session.update",
-        input_audio_format: "pcm16",
-        input_audio_transcription: {
-          model: "gpt-4o-transcribe",
-          language: "en"
-        },
-        turn_detection: {
-          type: "server_vad",
-          threshold: 0.5,
-          prefix_padding_ms: 300,
-          silence_duration_ms: 500,
-        },
-        input_audio_noise_reduction: {
-          type: "near_field"
-        }
-      };
-      
-      ws.send(JSON.stringify(config));
+      ws.send(sessionConfigFor(language));
       console.log(`[OpenAI Lib] Sent initial transcription configuration`);
       
       resolve(ws);
@@ -89,6 +150,182 @@ export async function openOpenAIRealtime(token: string): Promise<WebSocket> {
   });
 }
 
-if (!process.env.OPENAI_API_KEY) {
+/**
+ * Appends a chunk of PCM16 audio to the upstream input audio buffer.
+ */
+export function sendAudioChunk(ws: WebSocket, chunk: Buffer): void {
+  if (BINARY_FRAMES) {
+    ws.send(chunk, { binary: true });
+    return;
+  }
+
+  // Write the event straight into one Buffer and send it as a text frame, so
+  // ws does not have to UTF-8 encode a concatenated string again
+  const encoded = chunk.toString('base64');
+  const payload = Buffer.allocUnsafe(AUDIO_APPEND_PREFIX.length + encoded.length + AUDIO_APPEND_SUFFIX.length);
+  let offset = AUDIO_APPEND_PREFIX.copy(payload, 0);
+  offset += payload.write(encoded, offset, 'latin1');
+  AUDIO_APPEND_SUFFIX.copy(payload, offset);
+  ws.send(payload, { binary: false });
+}
+
+/**
+ * Returns a function that queues PCM16 chunks and forwards them as one
+ * append per event loop turn, so frames that arrive together share a
+ * single encode and upstream send.
+ */
+export function createAudioBatcher(ws: WebSocket): (chunk: Buffer) => void {
+  // A lone chunk is sent as received. Once a second one arrives in the same
+  // turn, chunks are copied into one buffer that then lives as long as the
+  // session and the flush encodes a view of it. Most turns carry a single
+  // chunk, so the buffer is only allocated the first time batching happens
+  let batch: Buffer | undefined;
+  let pendingChunk: Buffer | undefined;
+  let pendingBytes = 0;
+  let scheduled = false;
+  // Tracked locally so the per-chunk path does not query readyState
+  let upstreamOpen = ws.readyState === WebSocket.OPEN;
+  ws.once('close', () => {
+    upstreamOpen = false;
+  });
+
+  const flush = () => {
+    scheduled = false;
+    if (pendingBytes === 0) return;
+
+    let audio = pendingChunk;
+    if (audio === undefined) {
+      audio = batch!.subarray(0, pendingBytes);
+      // ws keeps a reference to binary frames until they are written and the
+      // batch buffer is reused, so those frames get their own copy
+      if (BINARY_FRAMES && upstreamOpen) {
+        audio = Buffer.from(audio);
+      }
+    }
+    pendingChunk = undefined;
+    pendingBytes = 0;
+    if (upstreamOpen) {
+      sendAudioChunk(ws, audio);
+    }
+  };
+
+  return (chunk) => {
+    if (pendingBytes + chunk.length > MAX_AUDIO_BATCH_BYTES) {
+      flush();
+      if (chunk.length > MAX_AUDIO_BATCH_BYTES) {
+        if (upstreamOpen) {
+          sendAudioChunk(ws, chunk);
+        }
+        return;
+      }
+    }
+    if (pendingBytes === 0) {
+      pendingChunk = chunk;
+    } else {
+      if (pendingChunk !== undefined) {
+        batch ??= Buffer.allocUnsafe(MAX_AUDIO_BATCH_BYTES);
+        pendingChunk.copy(batch, 0);
+        pendingChunk = undefined;
+      }
+      chunk.copy(batch!, pendingBytes);
+    }
+    pendingBytes += chunk.length;
+    if (!scheduled) {
+      scheduled = true;
+      setImmediate(flush);
+    }
+  };
+}
+
+// Static client messages are encoded once and reused for every connection
+export const CONNECTED_MESSAGE = Buffer.from(JSON.stringify({ type: 'connected', message: 'WebSocket connection established' }));
+export const READY_MESSAGE = Buffer.from(JSON.stringify({ ready: true }));
+export const UPSTREAM_ALREADY_STARTED_MESSAGE = Buffer.from(JSON.stringify({ error: "upstream_already_started" }));
+
+// Bytes queued for a client beyond which droppable messages are discarded
+const MAX_CLIENT_BUFFERED_BYTES = 256 * 1024;
+
+// Client-bound messages are UTF-8 JSON sent as binary frames. ws.send never
+// blocks, so a slow client would otherwise let its queue grow without bound;
+// droppable messages (partial transcripts) are shed once it backs up.
+export function sendToClient(client: WebSocket, payload: Buffer | string, droppable = false) {
+  if (droppable && client.bufferedAmount > MAX_CLIENT_BUFFERED_BYTES) {
+    if (DEBUG) {
+      console.log('[WebSocket] Client send queue full, dropping partial transcript');
+    }
+    return;
+  }
+  client.send(payload, { binary: true });
+}
+
+// Handlers for the OpenAI events we translate, keyed by event type.
+// Anything without a handler is forwarded to the client unchanged.
+const OPENAI_EVENT_HANDLERS = new Map<string, (client: WebSocket, clientIp: string, event: any) => void>([
+  ['conversation.item.input_audio_transcription.delta', (client, clientIp, event) => {
+    sendToClient(client, JSON.stringify({
+      type: 'partial',
+      text: event.delta,
+      item_id: event.item_id
+    }), true);
+  }],
+  ['conversation.item.input_audio_transcription.completed', (client, clientIp, event) => {
+    sendToClient(client, JSON.stringify({
+      type: 'final',
+      text: event.transcript,
+      item_id: event.item_id
+    }));
+  }],
+  ['input_audio_buffer.committed', (client, clientIp, event) => {
+    if (DEBUG) {
+      console.log(`[WebSocket] Audio committed for ${clientIp}, item: ${event.item_id}`);
+    }
+  }],
+  ['error', (client, clientIp, event) => {
+    console.error(`[WebSocket] OpenAI error for ${clientIp}:`, event);
+    sendToClient(client, JSON.stringify({
+      error: 'openai_error',
+      detail: event.error?.message || 'Unknown error'
+    }));
+  }],
+]);
+
+// Every event with a handler above contains one of these substrings; keep the
+// two in sync. Anything else is forwarded without being parsed.
+const HANDLED_EVENT_MARKERS = ['input_audio_transcription.', 'input_audio_buffer.committed', '"error"'];
+
+function mayHaveHandler(data: Buffer): boolean {
+  return HANDLED_EVENT_MARKERS.some((marker) => data.includes(marker));
+}
+
+/**
+ * Relays one upstream OpenAI event to the client, translating the events
+ * that have a handler and forwarding everything else unchanged.
+ */
+export function relayOpenAIMessage(client: WebSocket, clientIp: string, data: Buffer): void {
+  // Logged before the prefilter so forwarded events show up too
+  if (DEBUG) {
+    console.log(`[WebSocket] OpenAI message for ${clientIp}:`, data.toString('utf8', 0, 100));
+  }
+
+  if (!mayHaveHandler(data)) {
+    sendToClient(client, data);
+    return;
+  }
+
+  try {
+    const openaiMessage = JSON.parse(data.toString());
+    const handler = OPENAI_EVENT_HANDLERS.get(openaiMessage.type);
+    if (handler) {
+      handler(client, clientIp, openaiMessage);
+    } else {
+      sendToClient(client, data);
+    }
+  } catch (err) {
+    console.warn(`[WebSocket] Non-JSON from OpenAI for ${clientIp}:`, data.toString('utf8', 0, 100));
+    sendToClient(client, data);
+  }
+}
+
+if (!OPENAI_API_KEY) {
   console.warn('[OpenAI Lib] OPENAI_API_KEY is not set in your environment. Configure it in your environment.');
 } 
\ No newline at end of file
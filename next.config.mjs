@@ -1,6 +1,9 @@
 /** @type {import('next').NextConfig} */
 const nextConfig = {
   reactStrictMode: true,
+  // Serve /_next/static from a CDN when set, so asset requests never reach the
+  // process relaying WebSocket audio. Next already marks these files immutable.
+  assetPrefix: process.env.ASSET_PREFIX || undefined,
   experimental: {
     serverComponentsExternalPackages: ["ws"] // allow ws to be bundled for server
   }
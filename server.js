@@ -1,11 +1,31 @@
+// Must stay the first import so .env* is loaded before any module reads process.env
+import './lib/env.js';
+import cluster from 'cluster';
+import { availableParallelism } from 'os';
 import { createServer } from 'http';
 import { parse } from 'url';
 import next from 'next';
 import { WebSocketServer, WebSocket } from 'ws';
+import {
+  mintEphemeralToken,
+  openOpenAIRealtime,
+  createAudioBatcher,
+  normalizeLanguage,
+  relayOpenAIMessage,
+  sendToClient,
+  CONNECTED_MESSAGE,
+  READY_MESSAGE,
+  UPSTREAM_ALREADY_STARTED_MESSAGE,
+} from './lib/openai.js';
 
 const dev = process.env.NODE_ENV !== 'production';
 const hostname = 'localhost';
 const port = process.env.PORT || 3000;
+const DEFAULT_MODEL = process.env.MODEL_NAME || 'gpt-4o-transcribe';
+// Sessions are independent relays, so production runs one worker per core.
+// Dev always stays single-process: every `next dev` instance would write to
+// the same .next directory and run its own hot reloader.
+const workerCount = dev ? 1 : Number(process.env.WEB_CONCURRENCY) || availableParallelism();
 
 // Initialize Next.js app
 const app = next({ dev, hostname, port });
@@ -31,129 +51,111 @@ async function startServer() {
   // Create WebSocket server
   wss = new WebSocketServer({ 
     server,
-    path: '/api/ws/transcriptions'
+    path: '/api/ws/transcriptions',
+    // PCM audio barely compresses; deflate would only cost CPU per frame
+    perMessageDeflate: false
   });
 
   console.log('[Server] WebSocket server created on path: /api/ws/transcriptions');
 
-  wss.on('connection', async (client, req) => {
+  wss.on('connection', (client, req) => {
     const clientIp = req.headers['x-forwarded-for'] || req.socket?.remoteAddress || 'unknown';
     console.log(`[WebSocket] Client connected: ${clientIp}`);
     
     client.isAlive = true;
-    client.send(JSON.stringify({ type: 'connected', message: 'WebSocket connection established' }));
+    sendToClient(client, CONNECTED_MESSAGE);
 
     client.on('pong', () => {
       client.isAlive = true;
     });
 
-    client.on('message', async (message) => {
-      if (typeof message === 'string' || message instanceof Buffer) {
-        const messageStr = message.toString();
+    // Session setup is the only part that awaits. Keeping it out of the message
+    // handler means audio frames are handled without allocating a promise each.
+    const startTranscription = async (msg) => {
+      if (client.upstream && client.upstream.readyState === WebSocket.OPEN) {
+        console.warn(`[WebSocket] Client ${clientIp} tried to start existing upstream connection.`);
+        sendToClient(client, UPSTREAM_ALREADY_STARTED_MESSAGE);
+        return;
+      }
+
+      // Only the primary subtag is used (pt-BR becomes pt); anything else is rejected
+      const lang = normalizeLanguage(msg.lang || 'en');
+      if (lang === undefined) {
+        console.warn(`[WebSocket] Client ${clientIp} requested unsupported language:`, msg.lang);
+        sendToClient(client, JSON.stringify({ error: "unsupported_language", detail: `Unsupported language: ${msg.lang}` }));
+        return;
+      }
+      const model = msg.model || DEFAULT_MODEL;
+      console.log(`[WebSocket] Starting transcription for ${clientIp}. Lang: ${lang}, Model: ${model}`);
+
+      try {
+        console.log(`[WebSocket] Minting ephemeral token for ${clientIp}...`);
+        const token = await mintEphemeralToken(model);
+        console.log(`[WebSocket] Token minted successfully for ${clientIp}`);
         
-        try {
-          const msg = JSON.parse(messageStr);
-          console.log(`[WebSocket] Received JSON from ${clientIp}:`, msg);
-
-          if (msg.action === 'start') {
-            if (client.upstream && client.upstream.readyState === WebSocket.OPEN) {
-              console.warn(`[WebSocket] Client ${clientIp} tried to start existing upstream connection.`);
-              client.send(JSON.stringify({ error: "upstream_already_started" }));
-              return;
-            }
-
-            const lang = msg.lang || 'en';
-            const model = msg.model || process.env.MODEL_NAME || 'gpt-4o-transcribe';
-            console.log(`[WebSocket] Starting transcription for ${clientIp}. Lang: ${lang}, Model: ${model}`);
-
-            try {
-              console.log(`[WebSocket] Minting ephemeral token for ${clientIp}...`);
-              const { mintEphemeralToken } = await import('./lib/openai.js');
-              const token = await mintEphemeralToken(model);
-              console.log(`[WebSocket] Token minted successfully for ${clientIp}`);
-              
-              console.log(`[WebSocket] Opening upstream connection for ${clientIp}...`);
-              const { openOpenAIRealtime } = await import('./lib/openai.js');
-              const upstream = await openOpenAIRealtime(token);
-              client.upstream = upstream;
-              console.log(`[WebSocket] Upstream connection established for ${clientIp}`);
-
-              upstream.on('open', () => {
-                console.log(`[WebSocket] Upstream opened for ${clientIp}`);
-                client.send(JSON.stringify({ ready: true }));
-              });
-
-              upstream.on('message', (data) => {
-                try {
-                  const openaiMessage = JSON.parse(data.toString());
-                  console.log(`[WebSocket] OpenAI message for ${clientIp}:`, openaiMessage.type);
-                  
-                  if (openaiMessage.type === 'conversation.item.input_audio_transcription.delta') {
-                    client.send(JSON.stringify({ 
-                      type: 'partial', 
-                      text: openaiMessage.delta,
-                      item_id: openaiMessage.item_id 
-                    }));
-                  } else if (openaiMessage.type === 'conversation.item.input_audio_transcription.completed') {
-                    client.send(JSON.stringify({ 
-                      type: 'final', 
-                      text: openaiMessage.transcript,
-                      item_id: openaiMessage.item_id 
-                    }));
-                  } else if (openaiMessage.type === 'input_audio_buffer.committed') {
-                    console.log(`[WebSocket] Audio committed for ${clientIp}, item: ${openaiMessage.item_id}`);
-                  } else if (openaiMessage.type === 'error') {
-                    console.error(`[WebSocket] OpenAI error for ${clientIp}:`, openaiMessage);
-                    client.send(JSON.stringify({ 
-                      error: 'openai_error', 
-                      detail: openaiMessage.error?.message || 'Unknown error' 
-                    }));
-                  } else {
-                    client.send(data.toString());
-                  }
-                } catch (err) {
-                  console.warn(`[WebSocket] Non-JSON from OpenAI for ${clientIp}:`, data.toString().substring(0, 100));
-                  client.send(data.toString());
-                }
-              });
-
-              upstream.on('close', (code) => {
-                console.log(`[WebSocket] Upstream closed for ${clientIp}. Code: ${code}`);
-                if (client.readyState === WebSocket.OPEN) {
-                  client.close();
-                }
-                client.upstream = undefined;
-              });
-
-              upstream.on('error', (err) => {
-                console.error(`[WebSocket] Upstream error for ${clientIp}:`, err);
-                if (client.readyState === WebSocket.OPEN) {
-                  client.send(JSON.stringify({ error: "openai_connection_failed", detail: err.message }));
-                  client.close();
-                }
-                client.upstream = undefined;
-              });
-
-            } catch (err) {
-              console.error(`[WebSocket] Setup error for ${clientIp}:`, err);
-              client.send(JSON.stringify({ error: "upstream_setup_failed", detail: err.message }));
-            }
+        console.log(`[WebSocket] Opening upstream connection for ${clientIp}...`);
+        const upstream = await openOpenAIRealtime(token, lang);
+        if (client.readyState !== WebSocket.OPEN) {
+          // Client left while the upstream was connecting; close it instead of leaking it
+          console.log(`[WebSocket] Client ${clientIp} disconnected during setup, closing upstream`);
+          upstream.close();
+          return;
+        }
+        client.upstream = upstream;
+        client.sendAudio = createAudioBatcher(upstream);
+        console.log(`[WebSocket] Upstream connection established for ${clientIp}`);
+
+        // openOpenAIRealtime resolves once the socket is open, so 'open' has already fired
+        sendToClient(client, READY_MESSAGE);
+
+        upstream.on('message', (data) => relayOpenAIMessage(client, clientIp, data));
+
+        upstream.on('close', (code) => {
+          console.log(`[WebSocket] Upstream closed for ${clientIp}. Code: ${code}`);
+          if (client.readyState === WebSocket.OPEN) {
+            client.close();
           }
-        } catch (e) {
-          // Not JSON, check if it's binary audio data
-          if (message instanceof Buffer) {
-            if (client.upstream && client.upstream.readyState === WebSocket.OPEN) {
-              const base64Audio = message.toString('base64');
-              const audioEvent = {
-                type: "input_audio_buffer.append",
-                audio: base64Audio
-              };
-              client.upstream.send(JSON.stringify(audioEvent));
-            }
-          } else {
-            console.warn(`[WebSocket] Invalid message from ${clientIp}:`, messageStr.substring(0, 100));
+          client.upstream = undefined;
+          client.sendAudio = undefined;
+        });
+
+        upstream.on('error', (err) => {
+          console.error(`[WebSocket] Upstream error for ${clientIp}:`, err);
+          if (client.readyState === WebSocket.OPEN) {
+            sendToClient(client, JSON.stringify({ error: "openai_connection_failed", detail: err.message }));
+            client.close();
           }
+          client.upstream = undefined;
+          client.sendAudio = undefined;
+        });
+
+      } catch (err) {
+        console.error(`[WebSocket] Setup error for ${clientIp}:`, err);
+        sendToClient(client, JSON.stringify({ error: "upstream_setup_failed", detail: err.message }));
+      }
+    };
+
+    client.on('message', (message, isBinary) => {
+      // Binary frames are raw PCM16 audio; forward them without decoding to a string first
+      if (isBinary) {
+        // sendAudio is only set while an upstream session is attached
+        if (client.sendAudio) {
+          client.sendAudio(message);
         }
+        return;
+      }
+
+      const messageStr = message.toString();
+      
+      try {
+        const msg = JSON.parse(messageStr);
+        console.log(`[WebSocket] Received JSON from ${clientIp}:`, msg);
+
+        if (msg.action === 'start') {
+          startTranscription(msg);
+        }
+      } catch (e) {
+        console.warn(`[WebSocket] Invalid message from ${clientIp}:`, messageStr.substring(0, 100));
       }
     });
 
@@ -194,7 +196,32 @@ async function startServer() {
   });
 }
 
-startServer().catch((err) => {
-  console.error('Error starting server:', err);
-  process.exit(1);
-}); 
\ No newline at end of file
+if (cluster.isPrimary && workerCount > 1) {
+  console.log(`[Server] Primary ${process.pid} starting ${workerCount} workers`);
+  const listeningWorkers = new Set();
+
+  cluster.on('listening', (worker) => {
+    listeningWorkers.add(worker.id);
+  });
+
+  cluster.on('exit', (worker, code, signal) => {
+    console.error(`[Server] Worker ${worker.process.pid} exited. Code: ${code}, Signal: ${signal}`);
+    // Only replace workers that were serving; a worker that failed during startup would fail again
+    if (listeningWorkers.delete(worker.id)) {
+      cluster.fork();
+    } else if (listeningWorkers.size === 0 && Object.keys(cluster.workers).length === 0) {
+      // Every worker failed before serving, e.g. a missing build; exit non-zero like a single process would
+      console.error('[Server] No worker started listening, exiting');
+      process.exit(1);
+    }
+  });
+
+  for (let i = 0; i < workerCount; i++) {
+    cluster.fork();
+  }
+} else {
+  startServer().catch((err) => {
+    console.error('Error starting server:', err);
+    process.exit(1);
+  });
+} 
\ No newline at end of file